@@ -14,6 +14,9 @@ setup(name='target-csv',
           'singer-python==5.12.2',
           'pandas'
       ],
+      extras_require={
+          'fast': ['fastjsonschema', 'jsonschema-rs', 'orjson']
+      },
       entry_points='''
           [console_scripts]
           target-csv=target_csv:main
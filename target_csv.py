@@ -1,16 +1,25 @@
 #!/usr/bin/env python3
 
-import io
 import os
 import sys
 import json
 import csv
+import types
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 import pandas
 from pandas.errors import EmptyDataError
 
-from jsonschema.validators import Draft4Validator
+from jsonschema.validators import validator_for
+try:
+    import jsonschema_rs
+except ImportError:
+    jsonschema_rs = None
+try:
+    import fastjsonschema
+except ImportError:
+    fastjsonschema = None
 import singer
 from singer.schema import Schema
 from singer.catalog import Catalog, CatalogEntry
@@ -18,15 +27,72 @@ from target_helper import TargetHelper
 
 logger = singer.get_logger()
 REQUIRED_CONFIG_KEYS = []
-
-
-def persist_messages(delimiter, quotechar, messages, destination_path, field_mapping_file=None):
+FLUSH_ROWS = 10000
+
+_validator_cache = {}
+
+
+def compile_validator(schema):
+    # Singer schemas are draft-4 but rarely say so; without this the codegen
+    # backends default to a newer draft and reject draft-4-only constructs
+    # such as boolean exclusiveMinimum/exclusiveMaximum.
+    schema.setdefault('$schema', 'http://json-schema.org/draft-04/schema#')
+    key = json.dumps(schema, sort_keys=True)
+    if key not in _validator_cache:
+        if jsonschema_rs is not None:
+            if hasattr(jsonschema_rs, 'validator_for'):
+                _validator_cache[key] = jsonschema_rs.validator_for(schema).validate
+            else:
+                # Older releases exposed JSONSchema instead of validator_for.
+                _validator_cache[key] = jsonschema_rs.JSONSchema(schema).validate
+        elif fastjsonschema is not None:
+            _validator_cache[key] = fastjsonschema.compile(schema)
+        else:
+            cls = validator_for(schema)
+            cls.check_schema(schema)
+            _validator_cache[key] = cls(schema).validate
+    return _validator_cache[key]
+
+
+def iter_lines(buf, size=1 << 20):
+    tail = b''
+    while True:
+        chunk = buf.read(size)
+        if not chunk:
+            break
+        lines = (tail + chunk).split(b'\n')
+        tail = lines.pop()
+        for line in lines:
+            yield line.decode('utf-8')
+    if tail:
+        yield tail.decode('utf-8')
+
+
+def compile_projector(headers, field_mapping):
+    """Generate a function that turns a raw record into a positional row.
+
+    The header order and field renames are fixed per stream, so the
+    flatten-rename-project pipeline is specialized once into straight-line
+    code instead of re-walking the mapping dicts for every record.
+    """
+    inverse_mapping = {v: k for k, v in field_mapping.items()}
+    keys = [inverse_mapping.get(h, h) for h in headers]
+    src = ('def _project(record, flatten=TargetHelper.flatten):\n'
+           '    d = flatten(record)\n'
+           '    return [' + ', '.join('d.get({!r}, \'\')'.format(k) for k in keys) + ']\n')
+    namespace = {'TargetHelper': TargetHelper}
+    exec(src, namespace)
+    return namespace['_project']
+
+
+def persist_messages(delimiter, quotechar, messages, destination_path, field_mapping_file=None,
+                     skip_validation=False):
     state = None
     schemas = {}
     key_properties = {}
-    headers = {}
     validators = {}
     mappings = {}
+    streams = {}
 
     logger.info("Read fields mapping file, %s", field_mapping_file)
     if field_mapping_file:
@@ -35,61 +101,90 @@ def persist_messages(delimiter, quotechar, messages, destination_path, field_map
     logger.info("mappings. %s", mappings)
     now = datetime.now().strftime('%Y%m%dT%H%M%S')
 
-    for message in messages:
-        try:
-            o = singer.parse_message(message).asdict()
-            # o = json.loads(message + "}")
-        except json.decoder.JSONDecodeError:
-            logger.error("Unable to parse:\n{}".format(message))
-            raise
-        message_type = o['type']
-        if message_type == 'RECORD':
-            if o['stream'] not in schemas:
-                raise Exception("A record for stream {}"
-                                "was encountered before a corresponding schema".format(o['stream']))
-
-            validators[o['stream']].validate(o['record'])
-            stream_mapping = mappings.get(o['stream'], {})
-
-            filename = stream_mapping.get("to", o['stream'] + '-' + now) + '.csv'
-            filename = os.path.expanduser(os.path.join(destination_path, filename))
-            file_is_empty = (not os.path.isfile(filename)) or os.stat(filename).st_size == 0
-
-            flattened_record = TargetHelper.flatten(o['record'])
-            transformed_records = TargetHelper.transform(flattened_record, stream_mapping)
-            if o['stream'] not in headers and not file_is_empty:
-                with open(filename, 'r') as csvfile:
-                    reader = csv.reader(csvfile,
-                                        delimiter=delimiter,
-                                        quotechar=quotechar)
-                    first_line = next(reader)
-                    headers[o['stream']] = first_line if first_line else transformed_records.keys()
-            elif file_is_empty:
-                headers[o['stream']] = transformed_records.keys()
-
-            with open(filename, 'a') as csvfile:
-                writer = csv.DictWriter(csvfile,
-                                        headers[o['stream']],
-                                        extrasaction='ignore',
+    executor = ThreadPoolExecutor(max_workers=min(32, os.cpu_count() or 4))
+    try:
+        for message in messages:
+            try:
+                o = singer.parse_message(message).asdict()
+                # o = json.loads(message + "}")
+            except json.decoder.JSONDecodeError:
+                logger.error("Unable to parse:\n%s", message)
+                raise
+            message_type = o['type']
+            if message_type == 'RECORD':
+                stream = sys.intern(o['stream'])
+                if stream not in schemas:
+                    raise Exception("A record for stream {}"
+                                    "was encountered before a corresponding schema".format(stream))
+
+                if not skip_validation:
+                    validators[stream](o['record'])
+
+                s = streams.get(stream)
+                if s is None:
+                    stream_mapping = mappings.get(stream, {})
+                    field_mapping = stream_mapping.get('fields_mapping', {})
+                    filename = stream_mapping.get("to", stream + '-' + now) + '.csv'
+                    filename = os.path.expanduser(os.path.join(destination_path, filename))
+
+                    csvfile = open(filename, 'a+', newline='', encoding='utf-8',
+                                   buffering=1 << 20)
+                    file_is_empty = csvfile.tell() == 0
+                    headers = None
+                    if not file_is_empty:
+                        csvfile.seek(0)
+                        reader = csv.reader(csvfile,
+                                            delimiter=delimiter,
+                                            quotechar=quotechar)
+                        first_line = next(reader)
+                        if first_line:
+                            headers = tuple(first_line)
+                        csvfile.seek(0, os.SEEK_END)
+                    if headers is None:
+                        flattened_record = TargetHelper.flatten(o['record'])
+                        transformed_records = TargetHelper.transform(flattened_record, stream_mapping)
+                        headers = tuple(transformed_records.keys())
+
+                    writer = csv.writer(csvfile,
                                         delimiter=delimiter,
                                         quotechar=quotechar)
-                if file_is_empty:
-                    writer.writeheader()
-
-                writer.writerow(transformed_records)
-
-            state = None
-        elif message_type == 'STATE':
-            logger.debug('Setting state to {}'.format(o['value']))
-            state = o['value']
-        elif message_type == 'SCHEMA':
-            stream = o['stream']
-            schemas[stream] = o['schema']
-            validators[stream] = Draft4Validator(o['schema'])
-            key_properties[stream] = o['key_properties']
-        else:
-            logger.warning("Unknown message type {} in message {}"
-                           .format(o['type'], o))
+                    if file_is_empty:
+                        writer.writerow(headers)
+                    s = types.SimpleNamespace(csvfile=csvfile,
+                                              writer=writer,
+                                              projector=compile_projector(headers, field_mapping),
+                                              rows=[],
+                                              pending=None)
+                    streams[stream] = s
+
+                s.rows.append(s.projector(o['record']))
+                if len(s.rows) >= FLUSH_ROWS:
+                    # Wait for the stream's previous flush so rows stay ordered.
+                    if s.pending is not None:
+                        s.pending.result()
+                    s.pending = executor.submit(s.writer.writerows, s.rows)
+                    s.rows = []
+
+                state = None
+            elif message_type == 'STATE':
+                logger.debug('Setting state to %s', o['value'])
+                state = o['value']
+            elif message_type == 'SCHEMA':
+                stream = sys.intern(o['stream'])
+                schemas[stream] = o['schema']
+                validators[stream] = compile_validator(o['schema'])
+                key_properties[stream] = o['key_properties']
+            else:
+                logger.warning("Unknown message type %s in message %s",
+                               o['type'], o)
+    finally:
+        for s in streams.values():
+            if s.pending is not None:
+                s.pending.result()
+            if s.rows:
+                s.writer.writerows(s.rows)
+            s.csvfile.close()
+        executor.shutdown()
 
     return state
 
@@ -100,7 +195,7 @@ def read_csvs(path):
         list_csv = [file for file in os.listdir(path) if file[-4:] == ".csv"]
         for file in list_csv:
             try:
-                df = pandas.read_csv(path + file, sep='\t')
+                df = pandas.read_csv(os.path.join(path, file), sep='\t', nrows=0)
                 streams[file[:-4]] = Schema.from_dict({
                     "type": ["null", "object"],
                     "properties": {k: {"type": ["null", "string"]} for k in df.keys()}
@@ -143,13 +238,14 @@ def main():
         catalog = discover(config)
         catalog.dump()
     else:
-        input_messages = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8')
+        input_messages = iter_lines(sys.stdin.buffer)
 
         state = persist_messages(config.get('delimiter', ','),
                                  config.get('quotechar', '"'),
                                  input_messages,
                                  config.get('destination_path', ''),
-                                 args.fields_mapping)
+                                 args.fields_mapping,
+                                 config.get('skip_validation', False))
 
         TargetHelper.emit_state(state)
         logger.debug("Exiting normally")
@@ -1,7 +1,27 @@
 import sys
 import argparse
 import json
-import collections
+from collections.abc import Mapping
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import simplejson
+except ImportError:
+    simplejson = None
+
+if simplejson is not None:
+    # Records are parsed by singer with use_decimal=True, so list values can
+    # contain Decimals; simplejson (a pinned singer dependency) serializes
+    # them exactly where stdlib json and orjson raise TypeError.
+    def _dump_list(value):
+        return simplejson.dumps(value, use_decimal=True)
+else:
+    def _dump_list(value):
+        return json.dumps(value, default=str)
 
 from singer.catalog import Catalog
 import singer
@@ -12,21 +32,29 @@ class TargetHelper:
     @classmethod
     def emit_state(cls, state):
         if state is not None:
-            line = json.dumps(state)
-            logger.debug('Emitting state {}'.format(line))
+            if orjson is not None:
+                line = orjson.dumps(state).decode('utf-8')
+            else:
+                line = json.dumps(state)
+            logger.debug('Emitting state %s', line)
             sys.stdout.write("{}\n".format(line))
             sys.stdout.flush()
 
     @classmethod
     def flatten(cls, d, parent_key='', sep='__'):
-        items = []
-        for k, v in d.items():
-            new_key = parent_key + sep + k if parent_key else k
-            if isinstance(v, collections.MutableMapping):
-                items.extend(cls.flatten(v, new_key, sep=sep).items())
-            else:
-                items.append((new_key, str(v) if type(v) is list else v))
-        return dict(items)
+        flattened = {}
+        dump_list = _dump_list
+
+        def walk(prefix, current):
+            for k, v in current.items():
+                new_key = prefix + sep + k if prefix else k
+                if isinstance(v, Mapping):
+                    walk(new_key, v)
+                else:
+                    flattened[new_key] = dump_list(v) if isinstance(v, list) else v
+
+        walk(parent_key, d)
+        return flattened
 
     @classmethod
     def create_metadata_for_report(cls, schema, tap_stream_id):